@@ -1,13 +1,17 @@
+from gevent import monkey
+
+monkey.patch_all()
+
 import os
-import traceback
 from datetime import datetime
 
+import orjson
 from dotenv import load_dotenv
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
 from flask_cors import CORS
 
 from giacomino import Giacomino
-from utils import MyLogger, rate_limit, requires_env
+from utils import MyLogger, OrjsonProvider, rate_limit, requires_env
 
 load_dotenv()
 
@@ -18,11 +22,15 @@ logger = MyLogger(log_file=os.getenv("LOG_FILE", None))
 if not os.path.exists(".env"):
     logger.error("Missing .env")
 
+# Max characters per conversation
+MAX_CHARS = int(os.getenv("MAX_CHARS", 100000))
+
 # set port env
 os.environ["PORT"] = "5001"
 
 # Init app
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
 
 # Initialize Giacomino model
@@ -91,6 +99,8 @@ def chat():
         }
     )
     ```
+    Send `"stream": true` in the body to receive the response as
+    server-sent events (`data: {"text": ...}` frames, then `data: {"done": true}`).
     """
     if not giacomino:
         return jsonify({"error": "Model not available"}), 503
@@ -104,22 +114,46 @@ def chat():
         if not messages:
             return jsonify({"error": "Empty message"}), 400
 
-        if sum(len(msg["content"]) for msg in messages) > int(os.getenv("MAX_CHARS")):
-            return jsonify(
-                {
-                    "error": "Conversation exceeded the character limit. Please start a new chat to continue."
-                }
-            ), 400
+        total_chars = 0
+        for msg in messages:
+            total_chars += len(msg["content"])
+            if total_chars > MAX_CHARS:
+                return jsonify(
+                    {
+                        "error": "Conversation exceeded the character limit. Please start a new chat to continue."
+                    }
+                ), 400
+
+        if data.get("stream"):
+            return Response(
+                stream_with_context(_stream_chat(messages)),
+                mimetype="text/event-stream",
+            )
+
         # Generate response using Giacomino
         response = giacomino.generate_response(messages)
 
         return jsonify({"text": response, "timestamp": datetime.now().isoformat()})
 
     except Exception as e:
-        logger.error(f"Error in chat endpoint: {e}\n{traceback.format_exc()}")
+        logger.error("Error in chat endpoint", exc_info=e)
         return jsonify({"error": "Internal server error"}), 500
 
 
+def _stream_chat(messages):
+    """
+    Yields the model response as server-sent events.
+    """
+    try:
+        for chunk in giacomino.generate_response_stream(messages):
+            yield b"data: " + orjson.dumps({"text": chunk}) + b"\n\n"
+        done = {"done": True, "timestamp": datetime.now()}
+        yield b"data: " + orjson.dumps(done) + b"\n\n"
+    except Exception as e:
+        logger.error("Error in chat stream", exc_info=e)
+        yield b"data: " + orjson.dumps({"error": "Internal server error"}) + b"\n\n"
+
+
 @app.route("/history", methods=["GET"])
 @requires_env
 def get_history():
@@ -162,11 +196,3 @@ def not_found(error):
 @app.errorhandler(500)
 def internal_error(error):
     return jsonify({"error": "Internal server error"}), 500
-
-
-if __name__ == "__main__":
-    port = int(os.environ.get("PORT", 5000))
-    debug = os.environ.get("FLASK_ENV") == "development"
-
-    logger.info(f"Starting Flask app on port {port} with debug={debug}")
-    app.run(host="0.0.0.0", port=port, debug=debug)
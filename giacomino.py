@@ -1,18 +1,64 @@
+import hashlib
 import json
+import mmap
 import os
+import pickle
+import queue
+import re
+import string
+import tempfile
+import threading
 import time
+from concurrent.futures import Future
+from datetime import date
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterator, List, Optional
 
 import faiss
+import gevent
+import httpx
 import numpy as np
+import orjson
+from sentence_transformers import SentenceTransformer
 from together import Together
 
 from utils import MyLogger
 
 
+def _canonicalize(text: str) -> str:
+    # Collapse redundant whitespace once, so every request sends fewer tokens
+    text = re.sub(r"[ \t]+", " ", text)
+    text = re.sub(r" ?\n ?", "\n", text)
+    text = re.sub(r"\n{3,}", "\n\n", text)
+    return text.strip()
+
+
+def _atomic_write(path: str, data: bytes):
+    # Write to a unique temp file next to the target, then rename over it,
+    # so concurrent workers never read or clobber a partial file
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix=f".{os.path.basename(path)}.",
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+
+
+def _remove_stale(prefix: str, keep: str):
+    # Remove artifacts left over from previous content hashes
+    for path in Path(".").glob(f"{prefix}.*"):
+        if path.name != keep:
+            path.unlink(missing_ok=True)
+
+
 class Giacomino:
     version = "1.0.0"
+    index_type = "HNSWSQ8"
 
     def __init__(
         self,
@@ -26,60 +72,255 @@ class Giacomino:
             self.logger.error("TOGETHER_API_KEY environment variable not set")
             exit()
 
-        self.together = Together(api_key=self.together_api_key)
+        self.together = self._init_together_client()
         self.model_text = model_text
         self.model_embeddings = model_embeddings
 
+        # Embeddings are computed locally, Together is only used for chat
+        self.logger.info(f"Loading embedding model {self.model_embeddings}...")
+        self.embedder = SentenceTransformer(self.model_embeddings)
+
         self.index_file = "faiss_index.index"
         self.doc_file = "faiss_docs.pkl"
+        self.manifest_file = "manifest.json"
+        self.cache_file_prefix = "semantic_cache.pkl"
+        self.messages_file = "saved_messages.jsonl"
 
         self.top_k = int(os.environ.get("RETRIEVE_TOP_K", 1))
+        self.token_budget = int(os.environ.get("RETRIEVE_TOKEN_BUDGET", 2048))
+        self._inflight: Dict[str, Future] = {}
+        self._inflight_lock = threading.Lock()
+        self.inflight_timeout = float(os.environ.get("INFLIGHT_TIMEOUT", 60))
         self._load_prompts()
         self._load_documents()
+        self._load_cache()
+        self._start_log_writer()
+
+    def _init_together_client(self) -> Together:
+        # One long-lived HTTP/2 connection pool, so /chat skips the TCP+TLS handshake
+        http_client = httpx.Client(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=30.0),
+            timeout=httpx.Timeout(30.0),
+        )
+        try:
+            return Together(api_key=self.together_api_key, http_client=http_client)
+        except TypeError:
+            # Older SDK versions manage their own transport
+            http_client.close()
+            self.logger.warning("Together SDK does not accept http_client")
+            return Together(api_key=self.together_api_key)
 
     def _load_prompts(self):
         path_to_sys = Path("./system.txt")
         assert path_to_sys.exists()
         with open(path_to_sys, "r") as f:
-            self.system_prompt = f.read()
+            self.system_prompt = _canonicalize(f.read())
+        self._sys_template = string.Template(
+            self.system_prompt.replace("$", "$$")
+            .replace("{context}", "$context")
+            .replace("{date}", "$date")
+        )
+        self._today = ("", None)
         self.logger.info(f"System prompt loaded from {path_to_sys}")
 
     def _embed_texts(self, texts: List[str]) -> np.ndarray:
-        response = self.together.embeddings.create(
-            model=self.model_embeddings, input=texts
+        # Normalized so that inner product equals cosine similarity.
+        # Encoding is CPU-bound, so run it on a real thread to keep the
+        # gevent loop serving other requests meanwhile.
+        embeddings = gevent.get_hub().threadpool.apply(
+            self.embedder.encode,
+            (texts,),
+            {
+                "batch_size": 64,
+                "normalize_embeddings": True,
+                "convert_to_numpy": True,
+            },
         )
-        embeddings = [item.embedding for item in response.data]
-        return np.array(embeddings).astype("float32")
+        return embeddings.astype("float32")
 
     def _load_documents(self):
         self.logger.info("Loading docs...")
         docs_file = Path("documents.txt")
         assert docs_file.exists()
-        with open(docs_file, "r", encoding="utf-8") as f:
-            content = f.read()
-            # Split by "---" and strip whitespace
-            self.documents = [
-                chunk.strip() for chunk in content.split("---") if chunk.strip()
+        max_docs = 2 if os.getenv("FLASK_ENV") == "development" else None
+        self.documents = []
+        # Hash docs as they are read, to reuse the index from a previous run
+        # if docs and model are unchanged
+        h = hashlib.sha256()
+        with open(docs_file, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as mm:
+            # Split by "---" in place, decoding only one chunk at a time
+            start = 0
+            while start <= len(mm) and len(self.documents) != max_docs:
+                end = mm.find(b"---", start)
+                if end == -1:
+                    end = len(mm)
+                chunk = _canonicalize(mm[start:end].decode("utf-8"))
+                if chunk:
+                    if self.documents:
+                        h.update(b"---")
+                    h.update(chunk.encode())
+                    self.documents.append(chunk)
+                start = end + 3
+        h.update(str(self.model_embeddings).encode())
+        h.update(self.index_type.encode())
+        digest = h.hexdigest()
+        self._docs_digest = digest
+        index_file = f"{self.index_file}.{digest}"
+        doc_file = f"{self.doc_file}.{digest}"
+        if Path(index_file).exists() and Path(doc_file).exists():
+            self.logger.info(f"Reading cached index {index_file}...")
+            self.index = faiss.read_index(index_file)
+            with open(doc_file, "rb") as f:
+                self.documents = pickle.load(f)
+        else:
+            self.logger.info("Embedding docs...")
+            embeddings = self._embed_texts(self.documents)
+            self._build_index(embeddings)
+
+            self.logger.info("Writing index...")
+            _atomic_write(index_file, faiss.serialize_index(self.index).tobytes())
+            _atomic_write(doc_file, pickle.dumps(self.documents))
+            self._write_manifest(digest, index_file, doc_file)
+            _remove_stale(self.index_file, index_file)
+            _remove_stale(self.doc_file, doc_file)
+        self.index.hnsw.efSearch = max(64, self.top_k)
+        self._doc_array = np.array(self.documents, dtype=object)
+        # Approximate prompt tokens per doc, with the embedder's tokenizer
+        self._doc_token_counts = np.array(
+            [
+                len(ids)
+                for ids in self.embedder.tokenizer(
+                    self.documents, add_special_tokens=False
+                )["input_ids"]
             ]
-        if os.getenv("FLASK_ENV") == "development":
-            self.documents = self.documents[:2]
+        )
 
-        self.logger.info("Embedding docs...")
-        embeddings = self._embed_texts(self.documents)
+        self.logger.info(f"Loaded {len(self.documents)} documents into FAISS index")
 
-        self.logger.info("Writing index...")
-        self.index = faiss.IndexFlatL2(embeddings.shape[1])
+    def _build_index(self, embeddings: np.ndarray):
+        # HNSW graph over normalized vectors: inner product equals cosine.
+        # Vectors are stored as 8-bit scalars, a quarter of the FP32 size.
+        self.index = faiss.IndexHNSWSQ(
+            embeddings.shape[1],
+            faiss.ScalarQuantizer.QT_8bit,
+            32,
+            faiss.METRIC_INNER_PRODUCT,
+        )
+        self.index.hnsw.efConstruction = 200
+        self.index.train(embeddings)
         self.index.add(embeddings)
-        faiss.write_index(self.index, self.index_file)
 
-        self.logger.info(f"Loaded {len(self.documents)} documents into FAISS index")
+    def _write_manifest(self, digest: str, index_file: str, doc_file: str):
+        manifest = {
+            "hash": digest,
+            "model_embeddings": self.model_embeddings,
+            "index_type": self.index_type,
+            "index_file": index_file,
+            "doc_file": doc_file,
+        }
+        # Written last, once the files it points to are in place
+        _atomic_write(self.manifest_file, json.dumps(manifest, indent=2).encode())
+
+    def _load_cache(self):
+        self.cache_enabled = os.getenv("SEMANTIC_CACHE_ENABLED", "1") == "1"
+        self.cache_tau = float(os.getenv("SEMANTIC_CACHE_TAU", 0.95))
+        self.cache_persist_every = int(os.getenv("SEMANTIC_CACHE_PERSIST_EVERY", 10))
+        self.cache_max_entries = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", 1000))
+        self._cache_misses = 0
+        self._cache_lock = threading.Lock()
+
+        if not self.cache_enabled:
+            self.logger.info("Semantic cache disabled")
+            return
+
+        # Answers depend on the docs, the prompt and both models, so the
+        # cache is only reused while all of them are unchanged
+        digest = hashlib.sha256(
+            self._docs_digest.encode()
+            + self.system_prompt.encode()
+            + str(self.model_text).encode()
+        ).hexdigest()
+        self.cache_file = f"{self.cache_file_prefix}.{digest}"
+        _remove_stale(self.cache_file_prefix, self.cache_file)
+
+        if Path(self.cache_file).exists():
+            with open(self.cache_file, "rb") as f:
+                (
+                    index_bytes,
+                    self.cached_queries,
+                    self.cached_responses,
+                ) = pickle.load(f)
+            self.cache_index = faiss.deserialize_index(
+                np.frombuffer(index_bytes, dtype=np.uint8)
+            )
+        else:
+            self.cache_index = faiss.IndexFlatIP(self.index.d)
+            self.cached_queries, self.cached_responses = [], []
 
-    def retrieve_context(self, query: str) -> List[str]:
-        query_vec = self._embed_texts([query])
+        self.logger.info(
+            f"Semantic cache loaded with {len(self.cached_responses)} entries (tau={self.cache_tau})"
+        )
+
+    def _cache_lookup(self, query_vec: np.ndarray) -> Optional[str]:
+        if not self.cache_enabled:
+            return None
+        with self._cache_lock:
+            if self.cache_index.ntotal == 0:
+                return None
+            distances, indices = self.cache_index.search(query_vec, 1)
+            if distances[0, 0] >= self.cache_tau:
+                return self.cached_responses[indices[0, 0]]
+        return None
+
+    def _cache_store(self, query: str, query_vec: np.ndarray, response: str):
+        if not self.cache_enabled:
+            return
+        with self._cache_lock:
+            # Evict the oldest entry once the cache is full
+            if self.cache_index.ntotal >= self.cache_max_entries:
+                self.cache_index.remove_ids(np.array([0], dtype=np.int64))
+                self.cached_queries.pop(0)
+                self.cached_responses.pop(0)
+            self.cache_index.add(query_vec)
+            self.cached_queries.append(query)
+            self.cached_responses.append(response)
+
+            self._cache_misses += 1
+            if self._cache_misses % self.cache_persist_every != 0:
+                return
+            snapshot = (
+                faiss.serialize_index(self.cache_index).tobytes(),
+                list(self.cached_queries),
+                list(self.cached_responses),
+            )
+
+        # Persist off the request path
+        threading.Thread(
+            target=self._save_cache_to_disk, args=(snapshot,), daemon=True
+        ).start()
+
+    def _save_cache_to_disk(self, snapshot: tuple):
+        try:
+            # Index and responses share one file, replaced atomically
+            _atomic_write(self.cache_file, pickle.dumps(snapshot))
+            self.logger.info(f"Semantic cache saved with {len(snapshot[2])} entries")
+        except Exception as e:
+            self.logger.error(f"Failed to save semantic cache: {e}")
+
+    def retrieve_context(self, query_vec: np.ndarray) -> List[str]:
         distances, indices = self.index.search(query_vec, self.top_k)
-        return [self.documents[i] for i in indices[0] if i < len(self.documents)]
+        # FAISS pads with -1 when fewer than top_k results are found
+        ids = indices[0]
+        ids = ids[ids >= 0]
+        # Keep the best ranked docs that fit the token budget, at least one
+        tokens = np.cumsum(self._doc_token_counts[ids])
+        keep = max(1, int(np.searchsorted(tokens, self.token_budget, side="right")))
+        return self._doc_array[ids[:keep]].tolist()
 
-    def _send_chat_completion_request(self, system_prompt, messages) -> str:
+    def _send_chat_completion_request(self, system_prompt, messages) -> Iterator[str]:
         for mex in messages:
             assert mex["role"] in {"system", "assistant", "user"}
 
@@ -93,20 +334,66 @@ class Giacomino:
             max_tokens=512,
             temperature=0.7,
             top_p=0.9,
-            stream=False,
+            stream=True,
         )
 
-        return response.choices[0].message.content.strip()
+        for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
 
     def generate_response(self, messages: list) -> str:
+        # Identical in-flight requests wait on the first one instead of
+        # sending a duplicate completion request
+        key = hashlib.blake2b(
+            orjson.dumps(messages, option=orjson.OPT_SORT_KEYS), digest_size=16
+        ).hexdigest()
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        if not leader:
+            self.logger.info("Joining in-flight request")
+            response = future.result(timeout=self.inflight_timeout)
+            self._save_response(messages, response)
+            return response
+
+        try:
+            response = "".join(self.generate_response_stream(messages)).strip()
+            future.set_result(response)
+            return response
+        except BaseException as e:
+            # Always resolve the future, also on gevent Timeout / GreenletExit,
+            # but don't re-raise those inside the followers' greenlets
+            if isinstance(e, Exception):
+                future.set_exception(e)
+            else:
+                future.set_exception(RuntimeError("In-flight request was interrupted"))
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(key, None)
+
+    def generate_response_stream(self, messages: list) -> Iterator[str]:
         assert isinstance(messages, list) and messages
         assert messages[-1]["role"] == "user"
 
         # User message
         user_message = messages[-1]["content"]
+        query_vec = self._embed_texts([user_message])
+
+        # Semantic cache, only for single-turn chats: a follow-up like
+        # "tell me more" means something different in every conversation
+        cacheable = len(messages) == 1
+        response = self._cache_lookup(query_vec) if cacheable else None
+        if response is not None:
+            self.logger.info("Semantic cache hit")
+            self._save_response(messages, response)
+            yield response
+            return
 
         # Retrieve context
-        context_docs = self.retrieve_context(user_message)
+        context_docs = self.retrieve_context(query_vec)
         context = (
             "\n".join(context_docs)
             if context_docs
@@ -114,23 +401,57 @@ class Giacomino:
         )
 
         # Format prompt
-        system_prompt = self.system_prompt.format(
-            context=context, date=time.strftime("%B %-d, %Y")
+        system_prompt = self._sys_template.substitute(
+            context=context, date=self._get_date()
         )
 
-        # Get model response
-        response = self._send_chat_completion_request(system_prompt, messages)
+        # Stream model response, keeping the full text for cache and history
+        chunks = []
+        for chunk in self._send_chat_completion_request(system_prompt, messages):
+            chunks.append(chunk)
+            yield chunk
+        response = "".join(chunks).strip()
+        if cacheable:
+            self._cache_store(user_message, query_vec, response)
+
+        self._save_response(messages, response)
+
+    def _get_date(self) -> str:
+        # Only reformat the prompt date when the day changes
+        today = date.today()
+        if self._today[1] != today:
+            self._today = (time.strftime("%B %-d, %Y"), today)
+        return self._today[0]
 
-        # Save messages
+    def _save_response(self, messages: list, response: str):
+        # Build a new list rather than mutating the caller's messages
         timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-        messages.insert(0, {"timestamp": timestamp})
-        messages.append({"role": "assistant", "content": response})
-        self._save_messages_to_disk(messages)
-        return response
-
-    def _save_messages_to_disk(self, messages, filepath="saved_messages.jsonl"):
-        with open(filepath, "a", encoding="utf-8") as f:
-            f.write(json.dumps(messages) + "\n")
+        self._save_messages_to_disk(
+            [
+                {"timestamp": timestamp},
+                *messages,
+                {"role": "assistant", "content": response},
+            ]
+        )
+
+    def _start_log_writer(self):
+        self._log_q = queue.Queue()
+        self._log_fh = open(self.messages_file, "ab", buffering=1 << 16)
+        threading.Thread(target=self._log_worker, daemon=True).start()
+
+    def _log_worker(self):
+        while True:
+            messages = self._log_q.get()
+            try:
+                self._log_fh.write(orjson.dumps(messages) + b"\n")
+                # Flush once the backlog is drained, so /history stays current
+                if self._log_q.empty():
+                    self._log_fh.flush()
+            except Exception as e:
+                self.logger.error(f"Failed to save messages: {e}")
+
+    def _save_messages_to_disk(self, messages):
+        self._log_q.put_nowait(messages)
 
     def get_available_docs(self) -> Dict[str, Any]:
         try:
@@ -0,0 +1,14 @@
+import os
+
+# Run with: gunicorn -c gunicorn_conf.py app:app
+bind = f"0.0.0.0:{os.getenv('PORT', 5001)}"
+worker_class = "gevent"
+# Concurrency comes from gevent, not processes: /chat mostly waits on Together
+# and query embedding runs on gevent's threadpool, off the event loop.
+# Each worker loads its own embedding model and semantic cache, so keep it low.
+workers = int(os.getenv("GUNICORN_WORKERS", 1))
+worker_connections = 1000
+# Workers load (and on first boot download) the embedding model and embed the
+# documents at import time, which can take minutes. The app is not preloaded
+# because its background threads would not survive the fork into workers.
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 600))
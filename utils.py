@@ -1,12 +1,24 @@
+import collections
 import datetime
 import json
 import os
+import sys
+import threading
 import time
+import traceback
+import uuid
 from functools import wraps
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Optional, Union
 
+import orjson
+import redis
 from flask import jsonify, request
+from flask.json.provider import DefaultJSONProvider
+
+
+# Per-second timestamp cache: [epoch second, formatted timestamp]
+_last_timestamp = [0, ""]
 
 
 class MyLogger:
@@ -14,8 +26,13 @@ class MyLogger:
         self.name = name
         self.init_time = datetime.datetime.now()
         self.log_file = log_file
-        self.payload = ""
+        self.payload = collections.deque(
+            maxlen=int(os.getenv("LOG_BUFFER_LINES", 2000))
+        )
         self.log_count = 0
+        self.log_to_stdout = os.getenv("LOG_TO_STDOUT", "1") == "1"
+        self.flush_every = int(os.getenv("LOG_FLUSH_EVERY", 50))
+        self._unflushed = 0
         self.session_id = self.init_time.strftime("%Y%m%d_%H%M%S")
 
         # Create log directory if file logging is enabled
@@ -26,18 +43,22 @@ class MyLogger:
         self.log(f"Logger '{self.name}' initialized", level="INFO")
 
     def _format_message(self, message: str, level: str = "INFO") -> str:
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        return f"[{timestamp}] [{level}] [{self.name}] {message}"
+        # Only reformat the timestamp when the second changes
+        s = int(time.time())
+        if s != _last_timestamp[0]:
+            _last_timestamp[0] = s
+            _last_timestamp[1] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(s))
+        return f"[{_last_timestamp[1]}] [{level}] [{self.name}] {message}"
 
     def log(self, message: str, level: str = "INFO", print_console: bool = True):
         formatted_msg = self._format_message(message, level)
 
         # Print to console
-        if print_console:
-            print(formatted_msg)
+        if print_console and self.log_to_stdout:
+            self._write_to_stdout(formatted_msg, level)
 
         # Add to payload
-        self.payload += f"{formatted_msg}\n"
+        self.payload.append(formatted_msg)
         self.log_count += 1
 
         # Write to file if specified
@@ -50,12 +71,37 @@ class MyLogger:
     def warning(self, message: str):
         self.log(message, "WARNING")
 
-    def error(self, message: str):
-        self.log(message, "ERROR")
+    def error(self, message: str, exc_info: Optional[BaseException] = None):
+        if exc_info is None:
+            self.log(message, "ERROR")
+            return
+
+        # Keep only the exception line in memory, the full stack goes to the
+        # log file, or to stdout when there is no file sink
+        summary = traceback.format_exception_only(type(exc_info), exc_info)[-1]
+        self.log(f"{message}: {summary.strip()}", "ERROR")
+        if not self.log_file and not self.log_to_stdout:
+            return
+
+        stack = "".join(
+            traceback.format_exception(type(exc_info), exc_info, exc_info.__traceback__)
+        ).rstrip()
+        if self.log_file:
+            self._write_to_file(stack)
+        else:
+            self._write_to_stdout(stack, "ERROR")
 
     def debug(self, message: str):
         self.log(message, "DEBUG")
 
+    def _write_to_stdout(self, text: str, level: str):
+        # Flush only on warnings or every N lines
+        sys.stdout.write(f"{text}\n")
+        self._unflushed += 1
+        if level in {"WARNING", "ERROR"} or self._unflushed >= self.flush_every:
+            sys.stdout.flush()
+            self._unflushed = 0
+
     def _write_to_file(self, formatted_message: str):
         try:
             with open(self.log_file, "a", encoding="utf-8") as f:
@@ -86,12 +132,12 @@ class MyLogger:
         }
 
     def dumps(self) -> str:
-        """Return all logged messages as string"""
-        return self.payload
+        """Return the most recent logged messages as string"""
+        return "".join(f"{msg}\n" for msg in self.payload)
 
     def clear(self):
         """Clear the payload and reset log count"""
-        self.payload = ""
+        self.payload.clear()
         self.log_count = 0
         self.log("Logger cleared", level="INFO")
 
@@ -102,6 +148,24 @@ class MyLogger:
         return self.__str__()
 
 
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson.
+
+    Keys are not sorted and the indent/separators arguments are ignored,
+    so responses are always compact with keys in insertion order.
+    """
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(
+            obj,
+            default=kwargs.get("default", self.default),
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY,
+        ).decode()
+
+    def loads(self, s: Union[str, bytes], **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+
 def requires_env(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
@@ -112,8 +176,62 @@ def requires_env(func):
     return wrapper
 
 
-# In-memory store: {(user, endpoint): [timestamps]}
+# In-memory store: {(user, endpoint): [window_start, prev_count, curr_count]}
 rate_limit_store = {}
+rate_limit_lock = threading.Lock()
+
+# Shared store across gunicorn workers, enabled by setting REDIS_URL
+# Short timeouts so an unreachable Redis falls back fast instead of blocking /chat
+redis_client = None
+if os.getenv("REDIS_URL"):
+    redis_client = redis.Redis.from_url(
+        os.getenv("REDIS_URL"),
+        socket_connect_timeout=0.5,
+        socket_timeout=0.5,
+    )
+
+# Sliding window log in a sorted set, evaluated atomically in one round-trip
+RATE_LIMIT_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], 0, ARGV[1] - ARGV[2])
+local n = redis.call('ZCARD', KEYS[1])
+if n >= tonumber(ARGV[3]) then return {0, n} end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return {1, n}
+"""
+rate_limit_script = None
+if redis_client:
+    rate_limit_script = redis_client.register_script(RATE_LIMIT_SCRIPT)
+
+
+def _allow_local(key, now: float, window: int, request_count: int):
+    with rate_limit_lock:
+        # Sliding window counter: the previous fixed window is
+        # weighted by how much of it still overlaps the sliding one
+        bucket = rate_limit_store.setdefault(key, [now, 0, 0])
+        elapsed = now - bucket[0]
+        if elapsed >= window:
+            shift = int(elapsed // window)
+            bucket[1] = bucket[2] if shift == 1 else 0
+            bucket[2] = 0
+            bucket[0] += shift * window
+            elapsed = now - bucket[0]
+        count = bucket[1] * (1 - elapsed / window) + bucket[2]
+
+        if count >= request_count:
+            return False, count
+
+        # Record this request
+        bucket[2] += 1
+        return True, count
+
+
+def _allow_redis(key, now: float, window: int, request_count: int):
+    allowed, count = rate_limit_script(
+        keys=[f"rl:{key[0]}:{key[1]}"],
+        args=[now, window, request_count, f"{now}:{uuid.uuid4().hex}"],
+    )
+    return bool(allowed), count
 
 
 def rate_limit(request_count: int, h: int, logger=None):
@@ -129,24 +247,27 @@ def rate_limit(request_count: int, h: int, logger=None):
             now = time.time()
             window = h * 3600
 
-            # Get or create the list of timestamps
-            timestamps = rate_limit_store.get(key, [])
-            # Remove timestamps outside the window
-            timestamps = [ts for ts in timestamps if now - ts < window]
-
-            if len(timestamps) >= request_count:
+            if rate_limit_script is None:
+                allowed, count = _allow_local(key, now, window, request_count)
+            else:
+                try:
+                    allowed, count = _allow_redis(key, now, window, request_count)
+                except redis.RedisError as e:
+                    if logger:
+                        logger.warning(
+                            f"[RateLimit] Redis unavailable, using local store: {e}"
+                        )
+                    allowed, count = _allow_local(key, now, window, request_count)
+
+            if not allowed:
                 return jsonify(
                     {"error": "Rate limit exceeded. Please try again later."}
                 ), 429
 
-            log_msg = f"[RateLimit] Allowed: user={user}, endpoint={endpoint}, count={len(timestamps)}/{request_count} in last {h}h"
+            log_msg = f"[RateLimit] Allowed: user={user}, endpoint={endpoint}, count={int(count)}/{request_count} in last {h}h"
             if logger:
                 logger.info(log_msg)
 
-            # Record this request
-            timestamps.append(now)
-            rate_limit_store[key] = timestamps
-
             return func(*args, **kwargs)
 
         return wrapper